@@ -1,6 +1,13 @@
+from collections import deque
+import os
+import pickle
+import sys
+
 # These are "builtin" functions for working with cloaked variables
-# They may be implemented in c at some point to avoid the inspect
-# module, but this is pragmatic for now
+# They may be implemented in c at some point, for now they reach
+# directly into the calling frame with sys._getframe
+# Lookups are not cached, a loop comes back to the same f_lasti with
+# different locals and frame ids are reused once a frame is freed
 
 
 def getcloaked(name):
@@ -9,13 +16,7 @@ def getcloaked(name):
     var: str
         Variable name to look up
     '''
-    import inspect
-    outer = inspect.stack()
-    if len(outer) == 0:
-        ns = outer[0]
-    else:
-        ns = outer[1]
-    return ns.frame.f_locals[name]
+    return sys._getframe(1).f_locals[name]
 
 
 def setcloaked(name, value):
@@ -25,13 +26,7 @@ def setcloaked(name, value):
     var: str
         Variable name to look up
     '''
-    import inspect
-    outer = inspect.stack()
-    if len(outer) == 0:
-        ns = outer[0]
-    else:
-        ns = outer[1]
-    ns.frame.f_locals[name] = value
+    sys._getframe(1).f_locals[name] = value
 
 
 def cloaksset(var, deep=1):
@@ -40,13 +35,7 @@ def cloaksset(var, deep=1):
     var: str
         Variable name to look up
     '''
-    import inspect
-    outer = inspect.stack()
-    if len(outer) == 0:
-        ns = outer[0]
-    else:
-        ns = outer[deep]
-    return hasattr(ns.frame.f_locals[var], '__setself__')
+    return hasattr(type(sys._getframe(deep).f_locals[var]), '__setself__')
 
 
 def cloaksget(var, deep=1):
@@ -55,13 +44,7 @@ def cloaksget(var, deep=1):
     var: str
         Variable name to look up
     '''
-    import inspect
-    outer = inspect.stack()
-    if len(outer) == 0:
-        ns = outer[0]
-    else:
-        ns = outer[deep]
-    return hasattr(ns.frame.f_locals[var], '__getself__')
+    return hasattr(type(sys._getframe(deep).f_locals[var]), '__getself__')
 
 
 def iscloaked(var):
@@ -70,13 +53,19 @@ def iscloaked(var):
     var: str
         Variable name to look up
     '''
-    return cloaksset(var, deep=2) or cloaksget(var, deep=2)
+    cls = type(sys._getframe(1).f_locals[var])
+    return hasattr(cls, '__setself__') or hasattr(cls, '__getself__')
 
 
 class HistoricVar:
+    # Only the most recent values are kept, older ones are dropped once
+    # this many have been recorded
+    MAX_HISTORY = 1024
+
     def __init__(self, start):
         self.var = start
-        self.history = []
+        self._history = deque(maxlen=self.MAX_HISTORY)
+        self._history_snapshot = None
 
     def __repr__(self):
         return "This is a HistoricVar"
@@ -85,19 +74,28 @@ class HistoricVar:
         return self.var
 
     def __setself__(self, value):
-        self.history.append(self.var)
+        self._history.append(self.var)
+        self._history_snapshot = None
         self.var = value
 
     def rollback_n(self, n):
-        if n > len(self.history):
+        if n < 0:
+            raise ValueError("Can't roll back a negative number of steps")
+        if n > len(self._history):
             raise ValueError("Can't roll back before history started")
-        for i in range(n-1):
-            self.history.pop()
-
-        self.var = self.history.pop()
+        if n == 0:
+            return
+        self.var = self._history[-n]
+        for _ in range(n):
+            self._history.pop()
+        self._history_snapshot = None
 
     def get_history(self):
-        return list(self.history)
+        # The snapshot is shared until the next write, _history is private
+        # so only __setself__ and rollback_n change it
+        if self._history_snapshot is None:
+            self._history_snapshot = tuple(self._history)
+        return self._history_snapshot
 
 
 print("Demoing a variable with history:")
@@ -125,26 +123,28 @@ print()
 
 class FileBackedVar:
     def __init__(self, filename, starting):
-        self.file = open(filename, 'wb')
+        # Unbuffered, payloads are always written whole with pwrite
+        self.file = open(filename, 'wb', buffering=0)
         self.fileOpen = True
-        self.value = starting
         self.__setself__(starting)
 
     def __getself__(self):
         return self.value
 
     def __setself__(self, value):
-        import pickle  # noqa: F811
         self.value = value
         if self.fileOpen:
-            self.file.seek(0)
-            pickle.dump(value, self.file)
-            self.file.truncate()
+            # Write the whole payload at offset zero, then cut off anything
+            # left over from a longer previous value
+            payload = pickle.dumps(value)
+            fd = self.file.fileno()
+            os.pwrite(fd, payload, 0)
+            os.ftruncate(fd, len(payload))
 
     def close_file(self):
         if self.fileOpen:
             self.file.close()
-            self.FileOpen = False
+            self.fileOpen = False
 
 
 print("Demoing a variable that syncs to disk")
@@ -157,7 +157,6 @@ print("Close the backing file")
 getcloaked('fileVar').close_file()
 
 with open('exampleFileVar', 'rb') as f:
-    import pickle
     print("Load back in the saved var")
     value = pickle.load(f)
     print(f"The file var stored the value {value}")
@@ -169,20 +168,22 @@ print()
 
 
 class Context:
-    declaredContextVars = {}
+    # Bound setcontext method of each declared variable, keyed by name.
+    # Bound methods do not cloak, so run needs no decloak to call them
+    contextSetters = {}
 
     def __init__(self):
         self.context_dict = {}
 
     def run(self, goer):
-        for val in self.declaredContextVars.values():
-            getcloaked('val').setcontext(self.context_dict)
+        for setcontext in self.contextSetters.values():
+            setcontext(self.context_dict)
         goer()
 
 
 class ContextVar:
     def __init__(self, varname, default):
-        Context.declaredContextVars[varname] = self
+        Context.contextSetters[varname] = self.setcontext
         self.default = default
         self.varname = varname
 
@@ -291,11 +292,7 @@ class MachineState:
             the state of a machine part can only be above zero or below
             100
             '''
-            if value < 0:
-                value = 0
-            if value > 100:
-                value = 100
-            slf._fields[name] = value
+            slf._fields[name] = min(max(value, 0), 100)
         setter(self, start)
         inst_prop = InstanceProperty(self, getter, setter)  # noqa: F841
         # Need to directly assign the instance property, or decloak it.
@@ -329,20 +326,23 @@ class SimpleArrayExecutor:
         if len(nodes) < 1:
             raise ValueError("There must be at least one node at"
                              " initialization")
-        self.nodes = nodes
+        self.nodes = list(nodes)
         self.length = len(nodes[0].values)
         self.cached = None
 
     def __getself__(self):
         if self.cached is not None:
             return self.cached
+        if len(self.nodes) == 1:
+            # Nothing to add, but copy the lone node so the result does not
+            # alias an input
+            self.cached = SimpleArray(self.nodes[0].values)
+            return self.cached
         print("Doing all the additions")
-        addedValues = [0]*self.length
-        for i in range(self.length):
-            for node in self.nodes:
-                addedValues[i] += node.values[i]
-
-        self.cached = SimpleArray(addedValues)
+        # A single pass over the output, each element is summed across
+        # all nodes before moving on to the next
+        columns = zip(*(node.values for node in self.nodes))
+        self.cached = SimpleArray(map(sum, columns))
         return self.cached
 
     def __add__(self, other):
@@ -356,7 +356,11 @@ class SimpleArrayExecutor:
             self.nodes.append(other)
 
         if isinstance(other, SimpleArrayExecutor):
-            self.nodes += other.nodes
+            if other.length != self.length:
+                raise ValueError("Can only add Arrays of the same length")
+            self.nodes.extend(other.nodes)
+        # The node list changed, so any previously computed sum is stale
+        self.cached = None
         return self
 
 